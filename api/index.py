@@ -5,25 +5,203 @@ import os
 import io
 import re
 import base64
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-# Third-party imports
-import google.generativeai as genai
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import numpy as np
-from scipy import stats
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-import pdfplumber
+# Optional Redis backing for the response cache (shared across instances on Vercel)
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# orjson parses multi-kB Gemini output and MB-scale request bodies several
+# times faster than stdlib json; degrade transparently if it's missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj):
+    """Serialize to bytes (orjson) or str (stdlib) — both fine for Redis."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj)
+
+# Heavy third-party imports (genai, matplotlib, numpy/scipy, python-docx,
+# pypdf) are deferred to first use so cold starts — and the GET health
+# check in particular — don't pay hundreds of ms importing modules the
+# request never touches. Each sentinel is filled in by its _lazy_* helper.
+genai = None
+plt = None
+np = None
+stats = None
+Document = None
+Inches = None
+Pt = None
+RGBColor = None
+semantic_cache = None
+
+
+def _lazy_genai():
+    global genai
+    if genai is None:
+        import google.generativeai as _genai
+        genai = _genai
+    return genai
+
+
+def _lazy_plt():
+    global plt
+    if plt is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as _plt
+        plt = _plt
+        # rcParams is process-global — style once, right when pyplot arrives
+        configure_matlab_style()
+    return plt
+
+
+def _lazy_numpy():
+    global np, stats
+    if np is None:
+        import numpy as _np
+        from scipy import stats as _stats
+        np = _np
+        stats = _stats
+    return np
+
+
+# Style constants for assemble_document, built once alongside the docx
+# import — each Pt/RGBColor call goes through descriptor/unit conversion
+# and they all produce identical values every request
+_DARK_RED = None
+_RED = None
+_PT12 = None
+_PT11 = None
+_PT10 = None
+_PT0 = None
+_GRAPH_WIDTH = None
+
+
+def _lazy_docx():
+    global Document, Inches, Pt, RGBColor
+    global _DARK_RED, _RED, _PT12, _PT11, _PT10, _PT0, _GRAPH_WIDTH
+    if Document is None:
+        from docx import Document as _Document
+        from docx.shared import Inches as _Inches, Pt as _Pt, RGBColor as _RGBColor
+        Document = _Document
+        Inches = _Inches
+        Pt = _Pt
+        RGBColor = _RGBColor
+        _DARK_RED = RGBColor(139, 0, 0)
+        _RED = RGBColor(255, 0, 0)
+        _PT12 = Pt(12)
+        _PT11 = Pt(11)
+        _PT10 = Pt(10)
+        _PT0 = Pt(0)
+        _GRAPH_WIDTH = Inches(5.5)
+    return Document
+
+
+def _lazy_semantic_cache():
+    """Embedding-based cache for paraphrased-but-equivalent questions."""
+    global semantic_cache
+    if semantic_cache is None:
+        try:
+            import semantic_cache as _semantic_cache
+            semantic_cache = _semantic_cache
+        except ImportError:
+            semantic_cache = False
+    return semantic_cache or None
 
 app = Flask(__name__)
 CORS(app)
 
+# In-process cache of Gemini responses keyed by normalized question hash.
+# Repeat submissions of the same question skip the multi-second LLM call.
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # 24h, used for the Redis entries
+_response_cache = OrderedDict()
+# The Gemini fallback fans questions out over a thread pool, so every
+# OrderedDict mutation below must hold this lock — an unguarded eviction
+# between another thread's get and move_to_end raises KeyError
+_response_cache_lock = threading.Lock()
+_redis_client = None
+_redis_failed = False
+
+
+def _get_redis():
+    """Lazily connect to Redis if REDIS_URL is set; never raise."""
+    global _redis_client, _redis_failed
+    if _redis_client is not None or _redis_failed:
+        return _redis_client
+    redis_url = os.environ.get('REDIS_URL')
+    if not redis or not redis_url:
+        _redis_failed = True
+        return None
+    try:
+        _redis_client = redis.Redis.from_url(redis_url)
+    except Exception:
+        _redis_failed = True
+    return _redis_client
+
+
+def question_cache_key(question_text: str) -> str:
+    """Stable key for a question: SHA-256 of the normalized text."""
+    normalized = question_text.strip().lower()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def cache_get(key: str) -> dict:
+    """Look up a cached Gemini result locally, then in Redis."""
+    with _response_cache_lock:
+        result = _response_cache.get(key)
+        if result is not None:
+            _response_cache.move_to_end(key)
+            return result
+    r = _get_redis()
+    if r:
+        try:
+            blob = r.get(f'labauto:q:{key}')
+        except Exception:
+            return None
+        if blob:
+            result = _json_loads(blob)
+            with _response_cache_lock:
+                _response_cache[key] = result
+            return result
+    return None
+
+
+def cache_put(key: str, result: dict):
+    """Store a Gemini result in the local LRU and (best-effort) Redis."""
+    with _response_cache_lock:
+        _response_cache[key] = result
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+    r = _get_redis()
+    if r:
+        try:
+            r.setex(f'labauto:q:{key}', RESPONSE_CACHE_TTL, _json_dumps(result))
+        except Exception:
+            pass
+
 
 def configure_matlab_style():
     """Configure Matplotlib to mimic MATLAB default aesthetics."""
+    _lazy_plt()
     plt.style.use('default')
     plt.rcParams['font.family'] = 'sans-serif'
     plt.rcParams['font.sans-serif'] = ['Helvetica', 'Arial', 'DejaVu Sans']
@@ -42,37 +220,97 @@ def configure_matlab_style():
     )
 
 
-def extract_text_from_pdf(pdf_bytes: bytes) -> str:
-    text_parts = []
+def extract_text_from_pdf(pdf_bytes: bytes, max_pages: int = 20) -> str:
+    # pypdf skips pdfplumber's per-page layout model — we only need raw
+    # text. max_pages bounds the work on accidentally huge uploads.
+    # Stream page text into one growing buffer — each page's string can be
+    # collected immediately instead of a list of them staying live for a
+    # final join
+    import pypdf
+    reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+    buf = io.StringIO()
+    for page in reader.pages[:max_pages]:
+        page_text = page.extract_text()
+        if page_text:
+            if buf.tell():
+                buf.write('\n')
+            buf.write(page_text)
+    text = buf.getvalue()
+    if text.strip():
+        return text
+
+    # Some PDFs (odd encodings, scanned layers) defeat pypdf — fall back
+    # to pdfplumber's slower but more thorough extraction
+    import pdfplumber
+    buf = io.StringIO()
     with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-        for page in pdf.pages:
+        for page in pdf.pages[:max_pages]:
             page_text = page.extract_text()
             if page_text:
-                text_parts.append(page_text)
-    return '\n'.join(text_parts)
+                if buf.tell():
+                    buf.write('\n')
+                buf.write(page_text)
+    return buf.getvalue()
 
 
 def extract_text_from_docx(docx_bytes: bytes) -> str:
+    _lazy_docx()
+    from docx.oxml.ns import qn
     doc = Document(io.BytesIO(docx_bytes))
-    text_parts = []
-    for para in doc.paragraphs:
-        if para.text.strip():
-            text_parts.append(para.text)
-    return '\n'.join(text_parts)
+    # Walk the raw XML for w:p/w:t nodes instead of building python-docx
+    # Paragraph objects — para.text reconstructs each string from the tree
+    buf = io.StringIO()
+    for para_el in doc.element.body.iter(qn('w:p')):
+        para_text = ''.join(
+            t.text for t in para_el.iter(qn('w:t')) if t.text
+        )
+        if para_text.strip():
+            if buf.tell():
+                buf.write('\n')
+            buf.write(para_text)
+    return buf.getvalue()
+
+
+# Precompiled patterns — these run on every upload/response, so don't pay
+# recompilation (or even the re-module cache lookup) per call.
+# Alternations let one engine pass handle both fence ends / both
+# trailing-comma forms instead of two passes each
+_RE_FENCE = re.compile(r'^```(?:json)?\s*|\s*```$')
+_RE_TRAILING_COMMA = re.compile(r',(\s*[}\]])')
+_RE_BATCH_ITEM = re.compile(r'\{[^{}]*"matlab_code"[\s\S]*?"conclusion"[\s\S]*?\}')
+# One walk recovers all three fields; three separate searches each
+# rescanned the full response
+_RE_RESULT_FIELD = re.compile(
+    r'"(matlab_code|python_plotting_code|conclusion)"\s*:\s*"((?:\\.|[^"\\])*)"',
+    re.DOTALL)
+
+
+def _is_question_start(line: str) -> bool:
+    """True when a line opens like '1)', ' 2.', '10 )' — a question header.
+
+    Plain string scan: this runs on every line of the document, and the
+    old per-line regex paid the engine's entry cost thousands of times on
+    a multi-page upload.
+    """
+    s = line.lstrip()
+    if not s or not s[0].isdigit():
+        return False
+    i = 1
+    while i < len(s) and s[i].isdigit():
+        i += 1
+    while i < len(s) and s[i].isspace():
+        i += 1
+    return i < len(s) and s[i] in '.)'
 
 
 def split_questions(text: str) -> list:
     """Split input text into individual questions based on numbering patterns."""
-    lines = text.split('\n')
+    lines = text.splitlines()
     questions = []
     current_q = []
-    
-    # Pattern to detect question start: 1), 1., Q1, etc.
-    q_pattern = re.compile(r'^\s*(\d+)\s*[\.\)]\s*')
-    
+
     for line in lines:
-        match = q_pattern.match(line)
-        if match and len(current_q) > 0:
+        if _is_question_start(line) and len(current_q) > 0:
             # Save previous question
             q_text = '\n'.join(current_q).strip()
             if len(q_text) > 20:
@@ -94,17 +332,10 @@ def split_questions(text: str) -> list:
     return questions
 
 
-def call_gemini_single(question_text: str, question_num: int) -> dict:
-    """Call Gemini for high-quality MATLAB code generation."""
-    api_key = os.environ.get('GEMINI_API_KEY')
-    if not api_key:
-        raise ValueError("GEMINI_API_KEY environment variable not set")
-    
-    genai.configure(api_key=api_key)
-    # Use Gemini 3 Flash (stable, Dec 2025) for best quality
-    model = genai.GenerativeModel('gemini-3-flash')
-    
-    system_prompt = """You are an expert MATLAB programmer. Generate high-quality, professional MATLAB code.
+# Use Gemini 3 Flash (stable, Dec 2025) for best quality
+GEMINI_MODEL = 'gemini-3-flash'
+
+SYSTEM_PROMPT = """You are an expert MATLAB programmer. Generate high-quality, professional MATLAB code.
 
 REQUIREMENTS:
 1. Write clean, well-commented MATLAB code that would be used in an academic lab report
@@ -115,80 +346,235 @@ REQUIREMENTS:
 
 For the Python plotting code:
 - Use numpy (as np) and matplotlib.pyplot (as plt)
+- Vectorize all numeric work with numpy array operations — never loop element-by-element in Python over arrays with more than 1000 elements
 - For statistical distributions: use np.random and scipy.stats
 - Import scipy.stats as stats at the beginning of your code
 - Match the MATLAB output exactly
-- End with: plt.savefig(buffer, format='png', dpi=150, bbox_inches='tight')
+- End with: plt.savefig(buffer, format='png', dpi=100, bbox_inches='tight')
 
 OUTPUT FORMAT (JSON only, no markdown):
 {
   "matlab_code": "% Complete MATLAB code here",
   "python_plotting_code": "import numpy as np\\nimport matplotlib.pyplot as plt\\nfrom scipy import stats\\n... complete code ...",
-  "conclusion": "2-3 sentence academic conclusion"
-}"""
+  "conclusion": "2-3 sentence academic conclusion",
+  "plot_data": {"kind": "line", "x": [...], "y": [...], "xlabel": "...", "ylabel": "...", "title": "..."}
+}
+
+"plot_data" is optional: include it ONLY when the figure is a single simple chart ("kind" one of "line", "scatter", "bar", "hist"; omit "y" for "hist"). Keep arrays under 2000 points. For subplots or anything more complex, omit "plot_data" — the python_plotting_code will be used instead."""
+
+# Configure the SDK and build the model once per process instead of on
+# every call — lazy so a missing env var fails at request time, not import
+_genai_configured = False
+_model = None
+
+
+def _configure_genai():
+    global _genai_configured
+    _lazy_genai()
+    if _genai_configured:
+        return
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY environment variable not set")
+    genai.configure(api_key=api_key)
+    _genai_configured = True
+
+
+def _get_model():
+    global _model
+    _configure_genai()
+    if _model is None:
+        _model = genai.GenerativeModel(GEMINI_MODEL)
+    return _model
+
+
+# Structured-output schema: with response_mime_type="application/json"
+# the model returns pure JSON and the tolerant parser's repair stages
+# become dead weight kept only for older SDKs/models
+_RESULT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'matlab_code': {'type': 'string'},
+        'python_plotting_code': {'type': 'string'},
+        'conclusion': {'type': 'string'},
+        'plot_data': {
+            'type': 'object',
+            'properties': {
+                'kind': {'type': 'string'},
+                'x': {'type': 'array', 'items': {'type': 'number'}},
+                'y': {'type': 'array', 'items': {'type': 'number'}},
+                'bins': {'type': 'integer'},
+                'xlabel': {'type': 'string'},
+                'ylabel': {'type': 'string'},
+                'title': {'type': 'string'},
+            },
+        },
+    },
+    'required': ['matlab_code', 'python_plotting_code', 'conclusion'],
+}
+
+
+def _generation_config(max_output_tokens: int, schema=None):
+    """Build a GenerationConfig, requesting structured JSON output when
+    the installed SDK supports it."""
+    kwargs = {'temperature': 0.2, 'max_output_tokens': max_output_tokens}
+    if schema is not None:
+        try:
+            return genai.types.GenerationConfig(
+                response_mime_type='application/json',
+                response_schema=schema,
+                **kwargs
+            )
+        except TypeError:
+            pass  # older SDK without structured-output support
+    return genai.types.GenerationConfig(**kwargs)
+
+
+# Server-side cached copy of the shared system prompt, so each call only
+# pays prefill for the dynamic question tokens
+_cached_content = None
+# When context caching is unavailable for this account/model the create
+# call fails every time; memoize the failure (like _redis_failed) so we
+# stop paying the round-trip on every request for a while
+_cached_content_failed_at = 0.0
+CACHED_CONTENT_RETRY_SECONDS = 600
+
+
+def _drop_cached_content():
+    # TTL expiry is expected, not a failure — don't start the cooldown
+    global _cached_content
+    _cached_content = None
+
+
+def _get_cached_model():
+    """Return a model bound to the cached system prompt, or None if
+    context caching is unavailable (old SDK, quota, network)."""
+    global _cached_content, _cached_content_failed_at
+    if time.time() - _cached_content_failed_at < CACHED_CONTENT_RETRY_SECONDS:
+        return None
+    try:
+        _configure_genai()
+        if _cached_content is None:
+            _cached_content = genai.caching.CachedContent.create(
+                model=f'models/{GEMINI_MODEL}',
+                system_instruction=SYSTEM_PROMPT,
+                ttl='3600s',
+            )
+        return genai.GenerativeModel.from_cached_content(_cached_content)
+    except Exception:
+        _cached_content = None
+        _cached_content_failed_at = time.time()
+        return None
+
+
+def _parse_gemini(response_text: str) -> dict:
+    """Parse a Gemini result object, cheapest strategy first.
+
+    Stages: strict loads → raw_decode from the first '{' (one linear scan
+    that tolerates surrounding prose) → trailing-comma repair → a single
+    combined field-extraction walk as the last resort.
+    """
+    response_text = _RE_FENCE.sub('', response_text.strip())
+    start = response_text.find('{')
+    if start > 0:
+        response_text = response_text[start:]
+
+    try:
+        return _json_loads(response_text)
+    except ValueError:
+        pass
+    try:
+        result, _ = json.JSONDecoder().raw_decode(response_text)
+        return result
+    except ValueError:
+        pass
+    try:
+        return _json_loads(_RE_TRAILING_COMMA.sub(r'\1', response_text))
+    except ValueError:
+        pass
+
+    # Manual extraction — whatever fields are recoverable, in one pass
+    fields = dict(_RE_RESULT_FIELD.findall(response_text))
+    return {
+        'matlab_code': fields.get('matlab_code', '% Code parsing error'),
+        'python_plotting_code': fields.get('python_plotting_code', ''),
+        'conclusion': fields.get('conclusion', 'Conclusion parsing error')
+    }
+
+
+def call_gemini_single(question_text: str, question_num: int) -> dict:
+    """Call Gemini for high-quality MATLAB code generation."""
+    # Repeat submissions hit the cache and skip the LLM round-trip entirely
+    cache_key = question_cache_key(question_text)
+    cached = cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Configure before the semantic lookup — embedding calls need the SDK
+    # ready or the first request of every process silently misses
+    _configure_genai()
+
+    # Reworded versions of an already-answered question hit the semantic cache
+    sem_cache = _lazy_semantic_cache()
+    if sem_cache:
+        similar = sem_cache.lookup(question_text)
+        if similar is not None:
+            cache_put(cache_key, similar)
+            return similar
 
     prompt = f"""Question {question_num}:
 {question_text}
 
 Generate professional MATLAB code and equivalent Python plotting code."""
 
+    generation_config = _generation_config(8192, schema=_RESULT_SCHEMA)
+
     try:
-        response = model.generate_content(
-            [system_prompt, prompt],
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.2,
-                max_output_tokens=8192,
-            )
-        )
-        
-        response_text = response.text.strip()
-        
-        # Clean up response
-        response_text = re.sub(r'^```(?:json)?\s*', '', response_text)
-        response_text = re.sub(r'\s*```$', '', response_text)
-        
-        # Try to find JSON object
-        json_match = re.search(r'\{[\s\S]*\}', response_text)
-        if json_match:
-            response_text = json_match.group()
-        
-        # Parse JSON
-        try:
-            result = json.loads(response_text)
-        except json.JSONDecodeError:
-            # Try to fix common JSON issues
-            fixed = response_text
-            fixed = re.sub(r',\s*}', '}', fixed)
-            fixed = re.sub(r',\s*]', ']', fixed)
+        # Prefer the server-side cached system prompt; the shared prefix
+        # then skips prefill and only the question tokens are billed/new
+        model = _get_cached_model()
+        if model is not None:
             try:
-                result = json.loads(fixed)
-            except:
-                # Manual extraction
-                matlab_match = re.search(r'"matlab_code"\s*:\s*"((?:[^"\\]|\\.)*)"', response_text, re.DOTALL)
-                python_match = re.search(r'"python_plotting_code"\s*:\s*"((?:[^"\\]|\\.)*)"', response_text, re.DOTALL)
-                conclusion_match = re.search(r'"conclusion"\s*:\s*"((?:[^"\\]|\\.)*)"', response_text, re.DOTALL)
-                
-                result = {
-                    'matlab_code': matlab_match.group(1) if matlab_match else '% Code parsing error',
-                    'python_plotting_code': python_match.group(1) if python_match else '',
-                    'conclusion': conclusion_match.group(1) if conclusion_match else 'Conclusion parsing error'
-                }
-        
+                response = model.generate_content([prompt], generation_config=generation_config)
+            except Exception:
+                # Cached content likely expired — drop it and fall through
+                # to a plain call; the next request recreates the cache
+                _drop_cached_content()
+                model = None
+        if model is None:
+            model = _get_model()
+            response = model.generate_content(
+                [SYSTEM_PROMPT, prompt],
+                generation_config=generation_config
+            )
+
+        result = _parse_gemini(response.text)
+
         # Process the code
         matlab_code = result.get('matlab_code', '% No code generated')
         python_code = result.get('python_plotting_code', '')
         conclusion = result.get('conclusion', 'No conclusion.')
+        plot_data = result.get('plot_data')
         
         # Fix escaped characters
         matlab_code = matlab_code.replace('\\n', '\n').replace('\\t', '\t')
         python_code = python_code.replace('\\n', '\n').replace('\\t', '\t')
         
-        return {
+        result = {
             'matlab_code': matlab_code,
             'python_plotting_code': python_code,
             'conclusion': conclusion
         }
-        
+        if isinstance(plot_data, dict):
+            result['plot_data'] = plot_data
+
+        # Only cache successful generations, never the error fallback below
+        cache_put(cache_key, result)
+        if sem_cache:
+            sem_cache.store(question_text, result)
+
+        return result
+
     except Exception as e:
         return {
             'matlab_code': f'% Error: {str(e)[:100]}',
@@ -197,90 +583,436 @@ Generate professional MATLAB code and equivalent Python plotting code."""
         }
 
 
-def generate_graph(python_code: str) -> bytes:
-    """Execute Python plotting code and return PNG bytes."""
-    configure_matlab_style()
-    buffer = io.BytesIO()
-    
-    if not python_code or len(python_code.strip()) < 20:
-        # Generate a placeholder graph
-        fig, ax = plt.subplots(figsize=(8, 6))
-        ax.text(0.5, 0.5, 'Graph generation pending', 
-                ha='center', va='center', fontsize=14, color='gray')
-        ax.set_xlim(0, 1)
-        ax.set_ylim(0, 1)
-        ax.axis('off')
-        plt.savefig(buffer, format='png', dpi=150, bbox_inches='tight')
-        buffer.seek(0)
-        plt.close('all')
-        return buffer.read()
-    
-    # Full builtins + scipy.stats for statistical functions
-    exec_globals = {
-        'np': np,
-        'plt': plt,
-        'stats': stats,
-        'buffer': buffer,
-        '__builtins__': __builtins__,  # Use full builtins to allow imports
-    }
-    
+# Shared savefig settings: 100 dpi is plenty for the ~5.5in embed width in
+# the docx, and Pillow's optimizing encoder shrinks the PNGs further —
+# smaller documents, faster assembly and transfer
+_SAVEFIG_KWARGS = {
+    'format': 'png',
+    'dpi': 100,
+    'bbox_inches': 'tight',
+    'pil_kwargs': {'optimize': True, 'compress_level': 6},
+}
+
+# One figure reused for every in-process render (placeholder and error
+# images) — figure construction/teardown is a known matplotlib hotspot.
+# The lock serializes those draws now that graphs render concurrently.
+_fig = None
+_ax = None
+_fig_lock = threading.Lock()
+
+
+def _get_figure():
+    """Return the shared Figure/Axes, cleared and ready to draw on."""
+    global _fig, _ax
+    _lazy_plt()
+    if _fig is None:
+        _fig, _ax = plt.subplots(figsize=(8, 6))
+    _ax.clear()
+    _ax.set_axis_on()
+    return _fig, _ax
+
+
+# Builtins exposed to LLM plotting code, built once at import instead of
+# per render. An explicit list replaces the full __builtins__ passthrough;
+# __import__ stays because generated code imports numpy/matplotlib/scipy.
+# A plain dict (not MappingProxyType) is required by CPython's import
+# machinery — mutation isn't a concern since every render runs in a
+# forked child with its own copy-on-write view.
+_SAFE_BUILTINS = {name: getattr(__import__('builtins'), name) for name in (
+    'abs', 'all', 'any', 'bool', 'bytearray', 'bytes', 'callable', 'chr',
+    'complex', 'dict', 'divmod', 'enumerate', 'filter', 'float', 'format',
+    'frozenset', 'getattr', 'hasattr', 'hash', 'int', 'isinstance',
+    'issubclass', 'iter', 'len', 'list', 'map', 'max', 'min', 'next',
+    'object', 'ord', 'pow', 'print', 'range', 'repr', 'reversed', 'round',
+    'set', 'setattr', 'slice', 'sorted', 'str', 'sum', 'tuple', 'type',
+    'zip', '__import__', '__build_class__',
+    'ArithmeticError', 'AttributeError', 'Exception', 'FloatingPointError',
+    'ImportError', 'IndexError', 'KeyError', 'NameError', 'OverflowError',
+    'RuntimeError', 'StopIteration', 'TypeError', 'ValueError',
+    'ZeroDivisionError',
+)}
+_SAFE_BUILTINS['__name__'] = '<llm>'
+
+# Rendered PNGs keyed by a blake2b of the plotting code — Gemini returns
+# identical code for canonical problems, and a hit skips exec, the
+# subprocess, and matplotlib entirely
+_GRAPH_CACHE_SIZE = 64
+_graph_cache = OrderedDict()
+# Graph renders run on thread-pool workers too; same locking rule as
+# _response_cache
+_graph_cache_lock = threading.Lock()
+
+# Wall-clock cap on LLM-generated plotting code; without it a stray
+# `while True:` from the model would hang the request forever
+GRAPH_TIMEOUT_SECONDS = 10
+
+# Compiled code objects keyed by source hash — repeat renders of the same
+# code (cache hits, retries) skip the parse, and forked children inherit it
+_COMPILE_CACHE_SIZE = 64
+_compile_cache = OrderedDict()
+_compile_cache_lock = threading.Lock()
+
+
+def _compile_plot_code(python_code: str):
+    key = hash(python_code)
+    with _compile_cache_lock:
+        code_obj = _compile_cache.get(key)
+        if code_obj is not None:
+            _compile_cache.move_to_end(key)
+            return code_obj
+    code_obj = compile(python_code, '<llm>', 'exec')
+    with _compile_cache_lock:
+        _compile_cache[key] = code_obj
+        while len(_compile_cache) > _COMPILE_CACHE_SIZE:
+            _compile_cache.popitem(last=False)
+    return code_obj
+
+
+def _run_plot_code(python_code: str, conn):
+    """Child-process entry: execute plotting code, send PNG bytes back."""
     try:
-        plt.close('all')
-        
+        os.environ['MPLBACKEND'] = 'Agg'
+        _lazy_numpy()
+        _lazy_plt()  # imports pyplot and applies the MATLAB style once
+        buffer = io.BytesIO()
+
+        # Pre-bound numeric names + the explicit builtins whitelist
+        exec_globals = {
+            'np': np,
+            'plt': plt,
+            'stats': stats,
+            'buffer': buffer,
+            '__builtins__': _SAFE_BUILTINS,
+        }
+
         # Add scipy stats import if needed
         if 'from scipy' in python_code or 'scipy.stats' in python_code:
             exec_globals['scipy'] = __import__('scipy')
-        
-        exec(python_code, exec_globals)
-        
+
+        # Expose numba when installed so generated kernels can JIT scalar
+        # loops; compiled objects cache on /tmp across warm invocations
+        if 'numba' in python_code:
+            try:
+                os.environ.setdefault('NUMBA_CACHE_DIR', '/tmp/numba_cache')
+                exec_globals['numba'] = __import__('numba')
+            except ImportError:
+                pass
+
+        # Lock-free read of the inherited cache: another thread may have
+        # held _compile_cache_lock at fork time, so this child must not
+        # acquire it
+        code_obj = _compile_cache.get(hash(python_code))
+        if code_obj is None:
+            code_obj = compile(python_code, '<llm>', 'exec')
+        exec(code_obj, exec_globals)
+
         if buffer.tell() == 0:
-            plt.savefig(buffer, format='png', dpi=150, bbox_inches='tight',
-                       facecolor='white', edgecolor='none')
-        
-        buffer.seek(0)
-        return buffer.read()
+            plt.savefig(buffer, facecolor='white', edgecolor='none',
+                        **_SAVEFIG_KWARGS)
+
+        conn.send(('ok', buffer.getvalue()))
     except Exception as e:
-        plt.close('all')
-        fig, ax = plt.subplots(figsize=(8, 6))
-        error_msg = str(e)[:150]
+        conn.send(('error', str(e)[:150]))
+    finally:
+        conn.close()
+
+
+def _execute_plot_code(python_code: str):
+    """Run plotting code in a short-lived subprocess so runaway or crashing
+    LLM code can't hang the server or pollute its matplotlib state."""
+    import multiprocessing
+
+    # Warm the compile cache in the parent: forked children see it for free
+    try:
+        _compile_plot_code(python_code)
+    except SyntaxError as e:
+        return 'error', str(e)[:150]
+
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    proc = multiprocessing.Process(target=_run_plot_code,
+                                   args=(python_code, child_conn))
+    proc.start()
+    child_conn.close()
+
+    # Read before joining: a PNG bigger than the OS pipe buffer (~64KB)
+    # leaves the child blocked in send() until we recv, so join-first
+    # would misreport every large graph as a timeout
+    if parent_conn.poll(GRAPH_TIMEOUT_SECONDS):
+        try:
+            result = parent_conn.recv()
+        except EOFError:
+            result = ('error', 'Graph process exited without output')
+        proc.join()
+        return result
+
+    proc.terminate()
+    proc.join()
+    return 'error', f'Timed out after {GRAPH_TIMEOUT_SECONDS}s'
+
+
+def call_gemini_batch(questions: list, start_question_num: int = 1) -> list:
+    """Answer all questions with one Gemini call instead of N.
+
+    A single round-trip amortizes the system prompt and pays network
+    latency once. Questions already in the cache are served from it and
+    only the misses are sent. Returns a list of result dicts parallel to
+    `questions`, or None when the batched response can't be used — the
+    caller then falls back to per-question calls.
+    """
+    results = [None] * len(questions)
+    keys = []
+    miss_indices = []
+    for idx, q in enumerate(questions):
+        key = question_cache_key(q)
+        keys.append(key)
+        cached = cache_get(key)
+        if cached is not None:
+            results[idx] = cached
+        else:
+            miss_indices.append(idx)
+
+    if not miss_indices:
+        return results
+
+    _configure_genai()
+
+    # Reworded versions of already-answered questions hit the semantic
+    # cache, same as the single-question path
+    sem_cache = _lazy_semantic_cache()
+    if sem_cache:
+        still_missing = []
+        for idx in miss_indices:
+            similar = sem_cache.lookup(questions[idx])
+            if similar is not None:
+                cache_put(keys[idx], similar)
+                results[idx] = similar
+            else:
+                still_missing.append(idx)
+        miss_indices = still_missing
+        if not miss_indices:
+            return results
+
+    # Cap each question at 1500 chars so one oversized upload can't blow
+    # the shared prompt for the whole batch
+    numbered = '\n\n'.join(
+        f'Question {start_question_num + idx}:\n{questions[idx][:1500]}'
+        for idx in miss_indices
+    )
+    prompt = f"""Solve each of the following {len(miss_indices)} numbered questions.
+
+{numbered}
+
+Return ONLY a JSON array with exactly {len(miss_indices)} objects, one per
+question in the order given. Each object must have the keys "matlab_code",
+"python_plotting_code" and "conclusion" in the usual format."""
+
+    generation_config = _generation_config(
+        min(8192 * len(miss_indices), 32768),
+        schema={'type': 'array', 'items': _RESULT_SCHEMA},
+    )
+
+    try:
+        model = _get_cached_model()
+        if model is not None:
+            try:
+                response = model.generate_content([prompt], generation_config=generation_config)
+            except Exception:
+                _drop_cached_content()
+                model = None
+        if model is None:
+            model = _get_model()
+            response = model.generate_content(
+                [SYSTEM_PROMPT, prompt],
+                generation_config=generation_config
+            )
+
+        response_text = response.text.strip()
+        response_text = _RE_FENCE.sub('', response_text)
+
+        items = None
+        start = response_text.find('[')
+        if start != -1:
+            try:
+                items = _json_loads(response_text[start:])
+            except ValueError:
+                try:
+                    items, _ = json.JSONDecoder().raw_decode(response_text, start)
+                except ValueError:
+                    items = None
+        if not isinstance(items, list) or len(items) != len(miss_indices):
+            # Array-level parse failed — salvage the individual objects
+            items = []
+            for match in _RE_BATCH_ITEM.finditer(response_text):
+                try:
+                    items.append(_json_loads(match.group()))
+                except ValueError:
+                    return None
+            if len(items) != len(miss_indices):
+                return None
+
+        for idx, item in zip(miss_indices, items):
+            if not isinstance(item, dict):
+                return None
+            matlab_code = str(item.get('matlab_code', '% No code generated'))
+            python_code = str(item.get('python_plotting_code', ''))
+            result = {
+                'matlab_code': matlab_code.replace('\\n', '\n').replace('\\t', '\t'),
+                'python_plotting_code': python_code.replace('\\n', '\n').replace('\\t', '\t'),
+                'conclusion': str(item.get('conclusion', 'No conclusion.'))
+            }
+            if isinstance(item.get('plot_data'), dict):
+                result['plot_data'] = item['plot_data']
+            cache_put(keys[idx], result)
+            if sem_cache:
+                sem_cache.store(questions[idx], result)
+            results[idx] = result
+
+        return results
+
+    except Exception:
+        return None
+
+
+def render_plot_data(plot_data: dict) -> bytes:
+    """Render a structured plot description on the shared figure.
+
+    For simple single-axes charts Gemini returns the data arrays instead
+    of Python source, so rendering is one vectorized artist call with no
+    exec, no subprocess, and no LLM-authored loops. Returns None when the
+    description isn't usable — the caller falls back to the code path.
+    """
+    if not isinstance(plot_data, dict):
+        return None
+    kind = plot_data.get('kind', 'line')
+    if kind not in ('line', 'scatter', 'bar', 'hist'):
+        return None
+
+    _lazy_numpy()
+    try:
+        x = np.asarray(plot_data.get('x', []), dtype=np.float64)
+        y = np.asarray(plot_data.get('y', []), dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    if x.ndim != 1 or x.size == 0:
+        return None
+    if kind != 'hist' and (y.shape != x.shape):
+        return None
+
+    buffer = io.BytesIO()
+    with _fig_lock:
+        fig, ax = _get_figure()
+        try:
+            if kind == 'hist':
+                ax.hist(x, bins=plot_data.get('bins', 30), edgecolor='black')
+            elif kind == 'bar':
+                ax.bar(x, y)
+            elif kind == 'scatter':
+                ax.scatter(x, y, s=12)
+            else:
+                ax.plot(x, y)
+            ax.set_xlabel(str(plot_data.get('xlabel', '')))
+            ax.set_ylabel(str(plot_data.get('ylabel', '')))
+            ax.set_title(str(plot_data.get('title', '')))
+            ax.grid(True)
+            fig.savefig(buffer, **_SAVEFIG_KWARGS)
+        except Exception:
+            return None
+    return buffer.getvalue()
+
+
+def graph_for_response(ai_response: dict) -> bytes:
+    """Prefer the structured plot_data path; fall back to executing code."""
+    plot_data = ai_response.get('plot_data')
+    if plot_data:
+        png = render_plot_data(plot_data)
+        if png:
+            return png
+    return generate_graph(ai_response.get('python_plotting_code', ''))
+
+
+# The 'pending' image never changes — rendered at most once per process
+_placeholder_png = None
+
+
+def _get_placeholder_png() -> bytes:
+    global _placeholder_png
+    if _placeholder_png is None:
+        buffer = io.BytesIO()
+        with _fig_lock:
+            fig, ax = _get_figure()
+            ax.text(0.5, 0.5, 'Graph generation pending',
+                    ha='center', va='center', fontsize=14, color='gray')
+            ax.set_xlim(0, 1)
+            ax.set_ylim(0, 1)
+            ax.axis('off')
+            fig.savefig(buffer, **_SAVEFIG_KWARGS)
+        _placeholder_png = buffer.getvalue()
+    return _placeholder_png
+
+
+def generate_graph(python_code: str) -> bytes:
+    """Execute Python plotting code and return PNG bytes."""
+    buffer = io.BytesIO()
+
+    if not python_code or len(python_code.strip()) < 20:
+        return _get_placeholder_png()
+
+    # Repeat renders of the same code are a dict lookup
+    graph_key = hashlib.blake2b(python_code.encode('utf-8'), digest_size=16).digest()
+    with _graph_cache_lock:
+        cached = _graph_cache.get(graph_key)
+        if cached is not None:
+            _graph_cache.move_to_end(graph_key)
+            return cached
+
+    status, payload = _execute_plot_code(python_code)
+    if status == 'ok' and payload:
+        with _graph_cache_lock:
+            _graph_cache[graph_key] = payload
+            while len(_graph_cache) > _GRAPH_CACHE_SIZE:
+                _graph_cache.popitem(last=False)
+        return payload
+
+    # Error image — drawn in-process into the same buffer (it is still
+    # empty: the failed exec happened in the subprocess, not here)
+    with _fig_lock:
+        fig, ax = _get_figure()
+        error_msg = payload[:150]
         ax.text(0.5, 0.5, f'Graph Error:\n{error_msg}',
                ha='center', va='center', fontsize=9, color='red',
                wrap=True)
         ax.axis('off')
-        
-        error_buffer = io.BytesIO()
-        plt.savefig(error_buffer, format='png', dpi=150, bbox_inches='tight')
-        error_buffer.seek(0)
-        plt.close('all')
-        return error_buffer.read()
+        fig.savefig(buffer, **_SAVEFIG_KWARGS)
+    return buffer.getvalue()
 
 
-def assemble_document(questions_data: list, student_name: str, roll_number: str, lab_number: str) -> bytes:
+def assemble_document(questions_data: list, student_name: str, roll_number: str, lab_number: str) -> io.BytesIO:
     """
     Assemble a document matching the user's college template format.
     Header with name/roll/lab, red question text, code block, graph, output label.
     """
+    _lazy_docx()
     doc = Document()
-    
+
     # Header section
     if student_name:
         p = doc.add_paragraph()
         run = p.add_run(f"Name – {student_name}")
         run.bold = True
-        run.font.color.rgb = RGBColor(139, 0, 0)  # Dark red
-        run.font.size = Pt(12)
+        run.font.color.rgb = _DARK_RED
+        run.font.size = _PT12
     
     if roll_number:
         p = doc.add_paragraph()
         run = p.add_run(roll_number)
-        run.font.color.rgb = RGBColor(139, 0, 0)
-        run.font.size = Pt(12)
+        run.font.color.rgb = _DARK_RED
+        run.font.size = _PT12
     
     if lab_number:
         p = doc.add_paragraph()
         run = p.add_run(f"WCT LAB {lab_number}")
-        run.font.color.rgb = RGBColor(139, 0, 0)
-        run.font.size = Pt(12)
+        run.font.color.rgb = _DARK_RED
+        run.font.size = _PT12
     
     doc.add_paragraph()  # Spacing
     
@@ -288,32 +1020,41 @@ def assemble_document(questions_data: list, student_name: str, roll_number: str,
         # Question text in RED
         q_para = doc.add_paragraph()
         q_run = q_para.add_run(f"{item['question_num']})  {item['question'][:500]}")
-        q_run.font.color.rgb = RGBColor(255, 0, 0)  # Red
-        q_run.font.size = Pt(11)
+        q_run.font.color.rgb = _RED
+        q_run.font.size = _PT11
         
         doc.add_paragraph()  # Spacing
         
-        # MATLAB Code in black, code-style font
+        # MATLAB Code in black, code-style font — one paragraph with line
+        # breaks instead of a paragraph per source line, which built
+        # hundreds of XML elements for a typical 50-line snippet
         code_lines = item['matlab_code'].split('\n')
-        for line in code_lines:
-            p = doc.add_paragraph()
-            run = p.add_run(line)
-            run.font.name = 'Consolas'
-            run.font.size = Pt(10)
-            p.paragraph_format.space_after = Pt(0)
-            p.paragraph_format.space_before = Pt(0)
+        # A runaway generation can emit hundreds of lines; bound the XML
+        # tree (doc.save serializes linearly in node count)
+        if len(code_lines) > 200:
+            code_lines = code_lines[:200] + ['% ... (truncated)']
+        code_para = doc.add_paragraph()
+        code_para.paragraph_format.space_after = _PT0
+        code_para.paragraph_format.space_before = _PT0
+        code_run = code_para.add_run()
+        code_run.font.name = 'Consolas'
+        code_run.font.size = _PT10
+        for line_num, line in enumerate(code_lines):
+            if line_num:
+                code_run.add_break()
+            code_run.add_text(line)
         
         doc.add_paragraph()  # Spacing
         
         # Output label
         output_para = doc.add_paragraph()
         output_run = output_para.add_run("Output:")
-        output_run.font.color.rgb = RGBColor(255, 0, 0)
-        output_run.font.size = Pt(11)
+        output_run.font.color.rgb = _RED
+        output_run.font.size = _PT11
         
         # Graph
         if item['graph_bytes']:
-            doc.add_picture(io.BytesIO(item['graph_bytes']), width=Inches(5.5))
+            doc.add_picture(io.BytesIO(item['graph_bytes']), width=_GRAPH_WIDTH)
         
         doc.add_paragraph()  # Spacing
         
@@ -321,10 +1062,12 @@ def assemble_document(questions_data: list, student_name: str, roll_number: str,
         if item != questions_data[-1]:
             doc.add_page_break()
     
+    # Return the buffer itself — reading it out and re-wrapping would hold
+    # two full copies of a multi-MB, graph-heavy docx in memory
     output_buffer = io.BytesIO()
     doc.save(output_buffer)
     output_buffer.seek(0)
-    return output_buffer.read()
+    return output_buffer
 
 
 @app.route('/', methods=['GET'])
@@ -344,19 +1087,43 @@ def generate():
         return '', 200
     
     try:
-        data = request.get_json()
-        
-        question_text = data.get('question_text', '')
-        file_data = data.get('file_data')
-        file_type = data.get('file_type', '')
-        student_name = data.get('student_name', '')
-        roll_number = data.get('roll_number', '')
-        lab_number = data.get('lab_number', '')
-        start_question_num = data.get('start_question_num', 1)  # For batch continuation
-        
+        if request.content_type and request.content_type.startswith('multipart/'):
+            # Preferred path: raw binary upload — 33% smaller on the wire
+            # than base64-in-JSON and no decode pass over the file
+            form = request.form
+            question_text = form.get('question_text', '')
+            file_type = form.get('file_type', '')
+            student_name = form.get('student_name', '')
+            roll_number = form.get('roll_number', '')
+            lab_number = form.get('lab_number', '')
+            start_question_num = int(form.get('start_question_num', 1))
+
+            upload = request.files.get('file')
+            file_bytes = upload.read() if upload else None
+            if upload and not file_type:
+                filename = (upload.filename or '').lower()
+                if filename.endswith('.pdf'):
+                    file_type = 'pdf'
+                elif filename.endswith('.docx'):
+                    file_type = 'docx'
+        else:
+            # Legacy path: JSON body with the file base64-encoded.
+            # Parse with orjson when available — these payloads reach MB scale
+            raw_body = request.get_data(cache=False)
+            data = _json_loads(raw_body) if raw_body else {}
+
+            question_text = data.get('question_text', '')
+            file_data = data.get('file_data')
+            file_type = data.get('file_type', '')
+            student_name = data.get('student_name', '')
+            roll_number = data.get('roll_number', '')
+            lab_number = data.get('lab_number', '')
+            start_question_num = data.get('start_question_num', 1)  # For batch continuation
+
+            file_bytes = base64.b64decode(file_data) if file_data else None
+
         # Extract text from file if provided
-        if file_data and not question_text:
-            file_bytes = base64.b64decode(file_data)
+        if file_bytes and not question_text:
             if file_type == 'pdf':
                 question_text = extract_text_from_pdf(file_bytes)
             elif file_type == 'docx':
@@ -372,15 +1139,31 @@ def generate():
         if len(questions) > 4:
             questions = questions[:4]
         
-        # Process each question
+        # One batched call answers every question in a single round-trip;
+        # if its output can't be parsed, fall back to fanning out the
+        # per-question calls concurrently (wall time = max, not sum)
+        ai_responses = call_gemini_batch(questions, start_question_num)
+        if ai_responses is None:
+            with ThreadPoolExecutor(max_workers=min(len(questions), 8)) as executor:
+                futures = [
+                    executor.submit(call_gemini_single, q, i)
+                    for i, q in enumerate(questions, start_question_num)
+                ]
+                ai_responses = [f.result() for f in futures]
+
+        # Render graphs concurrently too: each render runs in its own
+        # subprocess, so threads here fan work out across cores without
+        # touching shared matplotlib state
+        with ThreadPoolExecutor(max_workers=min(len(questions), os.cpu_count() or 2)) as executor:
+            graph_futures = [
+                executor.submit(graph_for_response, r)
+                for r in ai_responses
+            ]
+            graphs = [f.result() for f in graph_futures]
+
         questions_data = []
-        for i, q in enumerate(questions, start_question_num):
-            # Call Gemini Pro
-            ai_response = call_gemini_single(q, i)
-            
-            # Generate graph
-            graph_bytes = generate_graph(ai_response['python_plotting_code'])
-            
+        for i, (q, ai_response, graph_bytes) in enumerate(
+                zip(questions, ai_responses, graphs), start_question_num):
             questions_data.append({
                 'question_num': i,
                 'question': q,
@@ -390,10 +1173,10 @@ def generate():
             })
         
         # Assemble document
-        doc_bytes = assemble_document(questions_data, student_name, roll_number, lab_number)
-        
+        doc_buffer = assemble_document(questions_data, student_name, roll_number, lab_number)
+
         return send_file(
-            io.BytesIO(doc_bytes),
+            doc_buffer,
             mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
             as_attachment=True,
             download_name='lab_report.docx'
@@ -0,0 +1,144 @@
+"""Semantic cache for Gemini responses.
+
+Exact-hash caching misses paraphrased-but-equivalent lab questions.
+This module embeds each question via the Gemini embeddings endpoint and
+returns a previously generated result when a new question is a
+near-duplicate (cosine similarity above threshold) of one already
+answered. Embeddings are kept in an in-memory matrix and persisted to
+/tmp so warm serverless instances keep their corpus across invocations.
+
+All failures (embedding API errors, corrupt persisted files) degrade to
+a cache miss — the main generation path must never break because of
+this cache.
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+import google.generativeai as genai
+
+EMBED_MODEL = 'models/text-embedding-004'
+SIMILARITY_THRESHOLD = 0.95
+MAX_ENTRIES = 512
+
+CACHE_DIR = os.environ.get('SEMANTIC_CACHE_DIR', '/tmp/labauto_semantic_cache')
+_EMBEDDINGS_PATH = os.path.join(CACHE_DIR, 'embeddings.npy')
+_RESPONSES_PATH = os.path.join(CACHE_DIR, 'responses.json')
+
+# (N, dim) float32 matrix of L2-normalized question embeddings,
+# parallel to _responses. Both run on thread-pool workers, so every
+# read/write of the pair must hold _lock — a lookup racing a store can
+# otherwise pair row i of one corpus with entry i of another and hand
+# back the answer to a different question
+_embeddings = None
+_responses = []
+_loaded = False
+_lock = threading.Lock()
+
+
+def _load():
+    """Restore the persisted corpus, if any, on first use.
+
+    Caller must hold _lock.
+    """
+    global _embeddings, _responses, _loaded
+    if _loaded:
+        return
+    _loaded = True
+    try:
+        if os.path.exists(_EMBEDDINGS_PATH) and os.path.exists(_RESPONSES_PATH):
+            embeddings = np.load(_EMBEDDINGS_PATH)
+            with open(_RESPONSES_PATH) as f:
+                responses = json.load(f)
+            if len(responses) == embeddings.shape[0]:
+                _embeddings = embeddings
+                _responses = responses
+    except Exception:
+        _embeddings = None
+        _responses = []
+
+
+def _persist(embeddings, responses):
+    """Best-effort save of a corpus snapshot for the next warm start.
+
+    Takes the snapshot as arguments so the disk I/O happens outside
+    _lock; racing stores may interleave writes, but _load rejects any
+    mismatched pair and degrades to an empty corpus.
+    """
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.save(_EMBEDDINGS_PATH, embeddings)
+        with open(_RESPONSES_PATH, 'w') as f:
+            json.dump(responses, f)
+    except Exception:
+        pass
+
+
+def _embed(text: str):
+    """Embed a question; returns a normalized float32 vector or None."""
+    try:
+        response = genai.embed_content(model=EMBED_MODEL, content=text)
+        vector = np.asarray(response['embedding'], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
+    except Exception:
+        return None
+
+
+def lookup(question_text: str):
+    """Return a cached result for a near-duplicate question, or None.
+
+    Never raises — any failure is a miss.
+    """
+    try:
+        with _lock:
+            _load()
+            if _embeddings is None or len(_responses) == 0:
+                return None
+            # Snapshot an aligned pair; stores rebind _embeddings rather
+            # than mutating it, so the copy keeps rows and responses in
+            # step while the similarity math runs unlocked
+            embeddings = _embeddings
+            responses = list(_responses)
+        query = _embed(question_text)
+        if query is None:
+            return None
+        # Rows are already normalized, so the dot product is cosine similarity
+        similarities = embeddings @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] > SIMILARITY_THRESHOLD:
+            return responses[best]
+        return None
+    except Exception:
+        return None
+
+
+def store(question_text: str, result: dict):
+    """Add a (question embedding, result) pair to the corpus.
+
+    Never raises — failures leave the corpus unchanged.
+    """
+    global _embeddings, _responses
+    try:
+        vector = _embed(question_text)
+        if vector is None:
+            return
+        with _lock:
+            _load()
+            if _embeddings is None:
+                _embeddings = vector[np.newaxis, :]
+                _responses = [result]
+            else:
+                _embeddings = np.vstack([_embeddings, vector[np.newaxis, :]])
+                _responses.append(result)
+                if len(_responses) > MAX_ENTRIES:
+                    _embeddings = _embeddings[-MAX_ENTRIES:]
+                    _responses = _responses[-MAX_ENTRIES:]
+            embeddings, responses = _embeddings, list(_responses)
+        _persist(embeddings, responses)
+    except Exception:
+        pass